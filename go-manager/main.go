@@ -1,15 +1,27 @@
 package main
 
 import (
+	"bufio"
+	"bytes"
 	"context"
 	"encoding/json"
+	"errors"
 	"flag"
 	"fmt"
+	"io"
+	"math"
 	"net/http"
+	"net/url"
 	"os"
 	"os/exec"
+	"os/signal"
+	"path/filepath"
+	"slices"
 	"sort"
+	"strconv"
 	"strings"
+	"sync"
+	"syscall"
 	"time"
 
 	"github.com/ProtonMail/go-proton-api"
@@ -20,14 +32,42 @@ const (
 	defaultCheckInt     = 300
 	defaultHealthInt    = 60
 	defaultLoadCheckInt = 900
+	defaultLogicalsTTL  = 300
 	pingTarget          = "8.8.8.8"
 	apiBaseURL          = "https://api.protonmail.ch"
+
+	// Load Switching
+	emaWeightPrev       = 0.7 // weight of the previous EMA vs. the new sample
+	minSwitchDelta      = 15  // minimum load points the current server must exceed the best by
+	relSwitchDelta      = 0.25
+	switchConfirmChecks = 2 // consecutive load checks required before a load-based switch
+
+	// Health Check Backoff
+	healthBackoffAfter = 5 // healthy checks before the interval starts stretching
+	maxHealthBackoff   = 5 // cap as a multiple of HEALTH_CHECK_INTERVAL
 )
 
+// Shared client for the Gluetun control server (short timeout, connections kept alive)
+var controlClient = &http.Client{Timeout: 5 * time.Second}
+
+// Shared client for the Proton API. Same settings as http.DefaultTransport, but idle
+// connections are kept for 5 minutes (vs. 90s) so failover bursts reuse the TLS connection.
+var apiClient = &http.Client{
+	Timeout:   30 * time.Second,
+	Transport: newAPITransport(),
+}
+
+func newAPITransport() *http.Transport {
+	t := http.DefaultTransport.(*http.Transport).Clone()
+	t.IdleConnTimeout = 5 * time.Minute
+	return t
+}
+
 // Configuration
 var (
 	targetCities       []string
-	targetCountry      string
+	targetCityKeys     []string // lowercased, trimmed, deduplicated, in TARGET_CITIES order
+	targetCountry      string // uppercased, trimmed
 	sessionFile        string
 	logDir             string
 	cacheDir           string
@@ -36,11 +76,20 @@ var (
 	checkInterval      int
 	healthCheckInterval int
 	loadCheckInterval  int
+	logicalsTTL        int
 
 	// Docker Configuration
 	gluetunService   string
 	gluetunContainer string
 	envFile          string
+
+	// Gluetun Control Server
+	gluetunControlURL        string
+	gluetunControlAPIKey     string
+	useDockerExecHealthcheck bool
+	useControlServerSwitch   bool
+
+	debugLogging bool
 )
 
 // VPN Server Structs (matching Proton API JSON)
@@ -87,8 +136,14 @@ func init() {
 		citiesEnv = "San Jose"
 	}
 	targetCities = strings.Split(citiesEnv, ",")
+	targetCityKeys = make([]string, 0, len(targetCities))
+	for _, city := range targetCities {
+		if key := strings.ToLower(strings.TrimSpace(city)); !slices.Contains(targetCityKeys, key) {
+			targetCityKeys = append(targetCityKeys, key)
+		}
+	}
 
-	targetCountry = os.Getenv("TARGET_COUNTRY")
+	targetCountry = strings.ToUpper(strings.TrimSpace(os.Getenv("TARGET_COUNTRY")))
 	sessionFile = getEnv("SESSION_FILE", "/data/proton_session.json")
 	logDir = getEnv("LOG_DIR", "/tmp/proton_sidecar/logs")
 	cacheDir = getEnv("CACHE_DIR", "/tmp/proton_sidecar/cache")
@@ -98,11 +153,20 @@ func init() {
 	checkInterval = getEnvInt("CHECK_INTERVAL", defaultCheckInt)
 	healthCheckInterval = getEnvInt("HEALTH_CHECK_INTERVAL", defaultHealthInt)
 	loadCheckInterval = getEnvInt("LOAD_CHECK_INTERVAL", defaultLoadCheckInt)
+	logicalsTTL = getEnvInt("LOGICALS_TTL", defaultLogicalsTTL)
 
 	// Docker Config
 	gluetunService = getEnv("GLUETUN_SERVICE_NAME", "gluetun")
 	gluetunContainer = getEnv("GLUETUN_CONTAINER_NAME", "gluetun")
 	envFile = getEnv("ENV_FILE_PATH", "/project/.env")
+
+	// Gluetun Control Server Config
+	gluetunControlURL = strings.TrimRight(getEnv("GLUETUN_CONTROL_URL", "http://network-anchor:8000"), "/")
+	gluetunControlAPIKey = os.Getenv("GLUETUN_CONTROL_API_KEY")
+	useDockerExecHealthcheck = getEnvBool("USE_DOCKER_EXEC_HEALTHCHECK", false)
+	useControlServerSwitch = getEnvBool("USE_CONTROL_SERVER_SWITCH", true)
+
+	debugLogging = strings.EqualFold(os.Getenv("LOG_LEVEL"), "debug")
 }
 
 func main() {
@@ -114,21 +178,25 @@ func main() {
 
 	log("VPN Manager Started")
 
+	// Cancelled on SIGTERM/SIGINT; threaded through every request, command and sleep
+	ctx, stop := signal.NotifyContext(context.Background(), syscall.SIGTERM, os.Interrupt)
+	defer stop()
+
 	if *listCities {
-		runListCities(*countryFilter)
+		runListCities(ctx, *countryFilter)
 		return
 	}
 
 	// Main Manager Logic
-	manager := NewProtonManager()
+	manager := NewProtonManager(ctx)
 	
 	if *checkOnly {
-		runCheckOnly(manager)
+		runCheckOnly(ctx, manager)
 		return
 	}
 
-	// Main Loop
-	runDaemon(manager)
+	// Main Loop (stops cleanly on SIGTERM/SIGINT)
+	runDaemon(ctx, manager)
 }
 
 // --- Manager Logic ---
@@ -139,12 +207,22 @@ type ProtonManager struct {
 	accessToken  string
 	uid          string
 	refreshToken string
+
+	// Smoothed per-server load, persisted next to the session file
+	loadEMA map[string]float64
+	// Consecutive load checks on which a load-based switch was warranted
+	switchStreak int
+	// Whether the last getServers call was answered by the API (a 200, or a 304 after the TTL) rather than a TTL cache hit
+	lastFetchLive bool
+	// The API rejected the filtered logicals query; stick to the full list
+	filterRejected bool
 }
 
-func NewProtonManager() *ProtonManager {
-	pm := &ProtonManager{}
+func NewProtonManager(ctx context.Context) *ProtonManager {
+	pm := &ProtonManager{loadEMA: make(map[string]float64)}
 	pm.ensureDirs()
-	pm.initSession()
+	pm.initSession(ctx)
+	pm.loadLoadHistory()
 	return pm
 }
 
@@ -153,12 +231,17 @@ func (pm *ProtonManager) ensureDirs() {
 	os.MkdirAll(cacheDir, 0755)
 	
 	sessionDir := getDir(sessionFile)
-	if _, err := os.Stat(sessionDir); os.IsNotExist(err) {
+	if info, err := os.Stat(sessionDir); os.IsNotExist(err) {
 		os.MkdirAll(sessionDir, 0700)
+	} else if err == nil && info.Mode().Perm() != 0700 {
+		// e.g. a bind mount Docker created as 0755; only chmod when actually needed
+		if err := os.Chmod(sessionDir, 0700); err != nil {
+			log(fmt.Sprintf("Warning: could not restrict session dir permissions: %v", err))
+		}
 	}
 }
 
-func (pm *ProtonManager) initSession() {
+func (pm *ProtonManager) initSession(ctx context.Context) {
 	pm.apiManager = proton.New(
 		proton.WithAppVersion("Other"),
 	)
@@ -168,7 +251,6 @@ func (pm *ProtonManager) initSession() {
 		log("Session loaded from disk.")
 		// Verify session by creating a client
 		// We use NewClientWithRefresh to ensure the tokens are valid/refreshed
-		ctx := context.Background()
 		c, auth, err := pm.apiManager.NewClientWithRefresh(ctx, pm.uid, pm.refreshToken)
 		if err == nil {
 			pm.client = c
@@ -182,17 +264,16 @@ func (pm *ProtonManager) initSession() {
 	}
 
 	// 2. Fresh Auth
-	pm.authenticate()
+	pm.authenticate(ctx)
 }
 
-func (pm *ProtonManager) authenticate() {
+func (pm *ProtonManager) authenticate(ctx context.Context) {
 	if protonUser == "" || protonPass == "" {
 		log("Error: PROTON_USERNAME and PROTON_PASSWORD must be set.")
 		os.Exit(1)
 	}
 
 	log(fmt.Sprintf("Authenticating as %s...", protonUser))
-	ctx := context.Background()
 	
 	// SRP Auth
 	c, auth, err := pm.apiManager.NewClientWithLogin(ctx, protonUser, []byte(protonPass))
@@ -235,63 +316,268 @@ func (pm *ProtonManager) saveSession() {
 		RefreshToken: pm.refreshToken,
 	}
 
-	f, err := os.Create(sessionFile)
+	// Tokens: owner-only, and tighten a file created by an older version
+	f, err := os.OpenFile(sessionFile, os.O_WRONLY|os.O_CREATE|os.O_TRUNC, 0600)
 	if err != nil {
 		log(fmt.Sprintf("Failed to save session: %v", err))
 		return
 	}
 	defer f.Close()
+	f.Chmod(0600)
 
 	json.NewEncoder(f).Encode(data)
 }
 
-// Fetch Servers using standard HTTP client with our AccessToken
-func (pm *ProtonManager) getServers() ([]LogicalServer, error) {
-	client := &http.Client{Timeout: 30 * time.Second}
-	req, err := http.NewRequest("GET", apiBaseURL+"/vpn/logicals", nil)
+// --- Load History ---
+
+func loadHistoryFile() string {
+	return getDir(sessionFile) + "/load_ema.json"
+}
+
+func (pm *ProtonManager) loadLoadHistory() {
+	f, err := os.Open(loadHistoryFile())
+	if err != nil {
+		return
+	}
+	defer f.Close()
+
+	var data map[string]float64
+	if err := json.NewDecoder(f).Decode(&data); err == nil && data != nil {
+		pm.loadEMA = data
+	}
+}
+
+func (pm *ProtonManager) saveLoadHistory() {
+	f, err := os.Create(loadHistoryFile())
+	if err != nil {
+		log(fmt.Sprintf("Failed to save load history: %v", err))
+		return
+	}
+	defer f.Close()
+
+	json.NewEncoder(f).Encode(pm.loadEMA)
+}
+
+// Fold a fresh sample of server loads into the EMA. Servers no longer listed are dropped.
+func (pm *ProtonManager) updateLoadEMA(servers []LogicalServer) {
+	ema := make(map[string]float64, len(servers))
+	for _, s := range servers {
+		load := float64(s.Load)
+		prev, ok := pm.loadEMA[s.Name]
+		if !ok {
+			prev = load
+		}
+		ema[s.Name] = emaWeightPrev*prev + (1-emaWeightPrev)*load
+	}
+	pm.loadEMA = ema
+	pm.saveLoadHistory()
+}
+
+// Smoothed load for name, or fallback if the server has no history
+func (pm *ProtonManager) smoothedLoad(name string, fallback int) float64 {
+	if v, ok := pm.loadEMA[name]; ok {
+		return v
+	}
+	return float64(fallback)
+}
+
+// Fetch the servers the daemon picks from. Status/country filtering is pushed to the API
+// to shrink the payload; findBestServer still filters, so ignored params are harmless.
+func (pm *ProtonManager) getServers(ctx context.Context) ([]LogicalServer, error) {
+	if pm.filterRejected {
+		return pm.getAllServers(ctx)
+	}
+
+	query := url.Values{"Status": {"1"}}
+	if targetCountry != "" {
+		query.Set("Countries", targetCountry)
+	}
+
+	servers, err := pm.getLogicals(ctx, query)
+	// Only a rejection of the query itself; 401/429 etc. would just repeat against the full list
+	var statusErr apiStatusError
+	if errors.As(err, &statusErr) && (statusErr == http.StatusBadRequest || statusErr == http.StatusUnprocessableEntity) {
+		log(fmt.Sprintf("Filtered server list rejected (%v), using the full list from now on.", err))
+		pm.filterRejected = true
+		return pm.getAllServers(ctx)
+	}
+	return servers, err
+}
+
+// Fetch the full, unfiltered server list (e.g. for --list-cities)
+func (pm *ProtonManager) getAllServers(ctx context.Context) ([]LogicalServer, error) {
+	return pm.getLogicals(ctx, nil)
+}
+
+// Fetch Servers, served from the on-disk cache while it is younger than logicalsTTL.
+// Each distinct query gets its own cache file.
+func (pm *ProtonManager) getLogicals(ctx context.Context, query url.Values) ([]LogicalServer, error) {
+	cacheName := "logicals"
+	if len(query) > 0 {
+		cacheName += "-" + strings.Map(func(r rune) rune {
+			if r >= 'a' && r <= 'z' || r >= 'A' && r <= 'Z' || r >= '0' && r <= '9' {
+				return r
+			}
+			return '_'
+		}, query.Encode())
+	}
+	bodyPath := filepath.Join(cacheDir, cacheName+".json")
+	etagPath := filepath.Join(cacheDir, cacheName+".etag")
+	pm.lastFetchLive = false
+
+	etag := ""
+	if info, err := os.Stat(bodyPath); err == nil {
+		cacheOK := true
+		// mtime is wall-clock: a negative age means the clock stepped backwards, so treat the cache as stale
+		if age := time.Since(info.ModTime()); age >= 0 && age < time.Duration(logicalsTTL)*time.Second {
+			servers, err := decodeLogicalsFile(bodyPath)
+			if err == nil {
+				logDebug(fmt.Sprintf("Using cached server list (age %s)", age.Round(time.Second)))
+				return servers, nil
+			}
+			log(fmt.Sprintf("Cached server list unreadable (%v), refetching.", err))
+			cacheOK = false
+		}
+		// Only revalidate a body we can actually read; otherwise a 304 would hand back the broken file
+		if !cacheOK {
+			os.Remove(etagPath)
+		} else if data, err := os.ReadFile(etagPath); err == nil {
+			etag = strings.TrimSpace(string(data))
+		}
+	}
+
+	body, newETag, notModified, err := pm.fetchLogicals(ctx, query, etag)
 	if err != nil {
 		return nil, err
 	}
 
+	if notModified {
+		servers, err := decodeLogicalsFile(bodyPath)
+		if err == nil {
+			// Unchanged upstream: bump the mtime so the TTL starts over.
+			// Still a sample: the API confirmed these are the current loads.
+			logDebug("Server list not modified, reusing cache.")
+			now := time.Now()
+			os.Chtimes(bodyPath, now, now)
+			pm.lastFetchLive = true
+			return servers, nil
+		}
+
+		// The cached body can't back the 304: drop its ETag and fetch unconditionally
+		log(fmt.Sprintf("Cached server list unreadable (%v), refetching.", err))
+		os.Remove(etagPath)
+		body, newETag, _, err = pm.fetchLogicals(ctx, query, "")
+		if err != nil {
+			return nil, err
+		}
+	}
+
+	if err := saveLogicalsCache(bodyPath, etagPath, body, newETag); err != nil {
+		log(fmt.Sprintf("Failed to cache servers: %v", err))
+	}
+	pm.lastFetchLive = true
+	return decodeLogicals(body)
+}
+
+// Non-2xx status from the Proton API
+type apiStatusError int
+
+func (e apiStatusError) Error() string {
+	return fmt.Sprintf("API returned status %d", int(e))
+}
+
+// Fetch the raw logicals list using standard HTTP client with our AccessToken.
+// If etag is set the request is conditional and notModified reports a 304.
+func (pm *ProtonManager) fetchLogicals(ctx context.Context, query url.Values, etag string) (body []byte, newETag string, notModified bool, err error) {
+	endpoint := apiBaseURL + "/vpn/logicals"
+	if len(query) > 0 {
+		endpoint += "?" + query.Encode()
+	}
+	req, err := http.NewRequestWithContext(ctx, "GET", endpoint, nil)
+	if err != nil {
+		return nil, "", false, err
+	}
+
 	req.Header.Set("Authorization", "Bearer "+pm.accessToken)
 	req.Header.Set("x-pm-appversion", "Other")
 	req.Header.Set("x-pm-uid", pm.uid)
+	if etag != "" {
+		req.Header.Set("If-None-Match", etag)
+	}
 
-	resp, err := client.Do(req)
+	resp, err := apiClient.Do(req)
 	if err != nil {
-		return nil, err
+		return nil, "", false, err
 	}
 	defer resp.Body.Close()
 
 	if resp.StatusCode == 401 {
 		// Token expired, refresh and retry once
 		log("Token expired (401). Refreshing...")
-		if err := pm.refreshSession(); err == nil {
+		if err := pm.refreshSession(ctx); err == nil {
 			req.Header.Set("Authorization", "Bearer "+pm.accessToken)
-			resp, err = client.Do(req)
+			resp, err = apiClient.Do(req)
 			if err != nil {
-				return nil, err
+				return nil, "", false, err
 			}
 			defer resp.Body.Close()
 		} else {
-			return nil, fmt.Errorf("failed to refresh session: %v", err)
+			return nil, "", false, fmt.Errorf("failed to refresh session: %v", err)
 		}
 	}
 
+	if resp.StatusCode == http.StatusNotModified && etag != "" {
+		return nil, etag, true, nil
+	}
+
 	if resp.StatusCode != 200 {
-		return nil, fmt.Errorf("API returned status %d", resp.StatusCode)
+		return nil, "", false, apiStatusError(resp.StatusCode)
+	}
+
+	body, err = io.ReadAll(resp.Body)
+	if err != nil {
+		return nil, "", false, err
 	}
+	return body, resp.Header.Get("ETag"), false, nil
+}
 
+func decodeLogicals(body []byte) ([]LogicalServer, error) {
 	var result LogicalServersResponse
-	if err := json.NewDecoder(resp.Body).Decode(&result); err != nil {
+	if err := json.Unmarshal(body, &result); err != nil {
+		return nil, err
+	}
+	return result.LogicalServers, nil
+}
+
+// Logicals Cache: the raw API body is stored as-is so it is only ever parsed once,
+// with its ETag kept in a separate file and its age taken from the body's mtime.
+func decodeLogicalsFile(path string) ([]LogicalServer, error) {
+	f, err := os.Open(path)
+	if err != nil {
 		return nil, err
 	}
+	defer f.Close()
 
+	var result LogicalServersResponse
+	if err := json.NewDecoder(bufio.NewReader(f)).Decode(&result); err != nil {
+		return nil, err
+	}
 	return result.LogicalServers, nil
 }
 
-func (pm *ProtonManager) refreshSession() error {
-	ctx := context.Background()
+func saveLogicalsCache(bodyPath, etagPath string, body []byte, etag string) error {
+	// Drop the old ETag first so it can never be paired with a newer body
+	os.Remove(etagPath)
+	if err := writeFileAtomic(bodyPath, body, 0644); err != nil {
+		return err
+	}
+	if etag == "" {
+		return nil
+	}
+	return os.WriteFile(etagPath, []byte(etag), 0644)
+}
+
+func (pm *ProtonManager) refreshSession(ctx context.Context) error {
 	// We close the old client if it exists to clean up
 	if pm.client != nil {
 		pm.client.Close()
@@ -303,7 +589,7 @@ func (pm *ProtonManager) refreshSession() error {
 		log("Refresh failed, attempting full re-authentication...")
 		// Use authenticate() but handle potential exit
 		// Since authenticate() exits on failure, this is fine for now
-		pm.authenticate()
+		pm.authenticate(ctx)
 		return nil 
 	}
 
@@ -317,28 +603,34 @@ func (pm *ProtonManager) refreshSession() error {
 
 // --- CLI Modes ---
 
-func runListCities(countryFilter string) {
-	// For listing cities, we need a manager to get servers
-	pm := NewProtonManager()
-	servers, err := pm.getServers()
+func runListCities(ctx context.Context, countryFilter string) {
+	// For listing cities, we need a manager to get the full (unfiltered) server list
+	pm := NewProtonManager(ctx)
+	servers, err := pm.getAllServers(ctx)
 	if err != nil {
 		log(fmt.Sprintf("Error fetching servers: %v", err))
 		os.Exit(1)
 	}
 
-	stats := make(map[string]struct {
+	type cityStatKey struct {
+		Country string
+		City    string
+	}
+	stats := make(map[cityStatKey]struct {
 		Count int
 		Load  int
 	})
 
-	for _, s := range servers {
+	countryFilter = strings.ToUpper(strings.TrimSpace(countryFilter))
+	for i := range servers {
+		s := &servers[i]
 		if s.Status != 1 {
 			continue
 		}
-		if countryFilter != "" && !strings.EqualFold(s.EntryCountry, countryFilter) {
+		if countryFilter != "" && s.EntryCountry != countryFilter {
 			continue
 		}
-		key := fmt.Sprintf("%s|%s", s.EntryCountry, s.City)
+		key := cityStatKey{s.EntryCountry, s.City}
 		entry := stats[key]
 		entry.Count++
 		entry.Load += s.Load
@@ -346,39 +638,42 @@ func runListCities(countryFilter string) {
 	}
 
 	// Sort and Print
-	var keys []string
+	keys := make([]cityStatKey, 0, len(stats))
 	for k := range stats {
 		keys = append(keys, k)
 	}
-	sort.Strings(keys)
+	sort.Slice(keys, func(i, j int) bool {
+		if keys[i].Country != keys[j].Country {
+			return keys[i].Country < keys[j].Country
+		}
+		return keys[i].City < keys[j].City
+	})
 
 	fmt.Println("------------------------------------------------------------")
 	fmt.Printf("%-8s %-30s %-10s %-10s\n", "COUNTRY", "CITY", "SERVERS", "AVG LOAD")
 	fmt.Println("------------------------------------------------------------")
 
 	for _, k := range keys {
-		parts := strings.Split(k, "|")
-		country, city := parts[0], parts[1]
 		data := stats[k]
 		avgLoad := 0
 		if data.Count > 0 {
 			avgLoad = data.Load / data.Count
 		}
-		fmt.Printf("%-8s %-30s %-10d %d%%\n", country, city, data.Count, avgLoad)
+		fmt.Printf("%-8s %-30s %-10d %d%%\n", k.Country, k.City, data.Count, avgLoad)
 	}
 	fmt.Println("------------------------------------------------------------")
 }
 
-func runCheckOnly(pm *ProtonManager) {
+func runCheckOnly(ctx context.Context, pm *ProtonManager) {
 	log("Running in CHECK ONLY mode...")
-	servers, err := pm.getServers()
+	servers, err := pm.getServers(ctx)
 	if err != nil {
 		log(fmt.Sprintf("Error: %v", err))
 		os.Exit(1)
 	}
 
 	currentName := getCurrentServerFromEnv()
-	best, _ := findBestServer(servers, currentName)
+	best, _ := pm.findBestServer(indexServers(servers), currentName)
 
 	if best != nil {
 		fmt.Printf("\n--- REPORT ---\n")
@@ -393,46 +688,84 @@ func runCheckOnly(pm *ProtonManager) {
 
 // --- Daemon Logic ---
 
-func runDaemon(pm *ProtonManager) {
+func runDaemon(ctx context.Context, pm *ProtonManager) {
+	defer func() {
+		log("Shutting down...")
+		pm.saveSession()
+		pm.saveLoadHistory()
+	}()
+
+	// Deadlines are only ever derived from time.Now(), whose monotonic reading makes
+	// Sub/Add immune to NTP steps. Don't round, serialize or rebuild these from Unix time.
 	lastHealth := time.Time{}
 	lastLoad := time.Time{}
+	loadEvery := time.Duration(loadCheckInterval) * time.Second
+	consecutiveHealthy := 0
+	// Whether Gluetun's live endpoint has been checked against .env since start or since it was last unhealthy
+	endpointSynced := !useControlServerSwitch
 
 	for {
 		now := time.Now()
 
 		// 1. Health Check
-		if now.Sub(lastHealth) >= time.Duration(healthCheckInterval)*time.Second {
+		if now.Sub(lastHealth) >= healthCheckEvery(consecutiveHealthy) {
 			lastHealth = now
-			healthy := checkConnectivity()
+			healthy := checkConnectivity(ctx)
+			if ctx.Err() != nil {
+				return
+			}
 			
 			if !healthy {
+				consecutiveHealthy = 0
+				endpointSynced = !useControlServerSwitch
 				log("Unhealthy connection detected! Initiating failover...")
 				// Force immediate load check to switch
 				lastLoad = time.Time{} 
 			} else {
-				// If healthy, wait before checking load
-				if now.Sub(lastLoad) < time.Duration(loadCheckInterval)*time.Second {
-					time.Sleep(5 * time.Second)
-					continue
+				consecutiveHealthy++
+				logDebug(fmt.Sprintf("Health check OK (%d in a row, next in %s)", consecutiveHealthy, healthCheckEvery(consecutiveHealthy)))
+				if !endpointSynced {
+					endpointSynced = reconcileGluetunEndpoint(ctx)
 				}
 			}
 		}
 
 		// 2. Load Check / Failover
-		if now.Sub(lastLoad) >= time.Duration(loadCheckInterval)*time.Second {
+		if now.Sub(lastLoad) >= loadEvery {
 			lastLoad = now
-			
-			servers, err := pm.getServers()
+
+			// Probe health while the server list is fetched; neither depends on the other.
+			// Buffered so the probe never blocks if we bail out early.
+			healthCh := make(chan bool, 1)
+			go func() { healthCh <- checkConnectivity(ctx) }()
+
+			servers, err := pm.getServers(ctx)
+			if ctx.Err() != nil {
+				return
+			}
 			if err != nil {
 				log(fmt.Sprintf("Error fetching servers: %v", err))
-				time.Sleep(30 * time.Second)
+				if !sleepCtx(ctx, 30*time.Second) {
+					return
+				}
 				continue
 			}
 
 			currentName := getCurrentServerFromEnv()
-			healthy := checkConnectivity()
-			
-			best, currentLoad := findBestServer(servers, currentName)
+			healthy := <-healthCh
+			if !healthy {
+				consecutiveHealthy = 0
+			} else if useControlServerSwitch {
+				// Also catches a Gluetun restart that happened between two health checks
+				endpointSynced = reconcileGluetunEndpoint(ctx)
+			}
+			// Each answer from the API (200 or 304) is a load sample; a TTL cache hit must not be counted twice
+			newSample := pm.lastFetchLive
+			if newSample {
+				pm.updateLoadEMA(servers)
+			}
+
+			best, currentLoad := pm.findBestServer(indexServers(servers), currentName)
 			
 			// Logging
 			status := "BAD"
@@ -454,186 +787,701 @@ func runDaemon(pm *ProtonManager) {
 				if best != nil {
 					target = best.Name
 				}
-			} else if best != nil && currentName != "" {
-				if currentLoad > (best.Load + 20) {
-					shouldSwitch = true
-					target = best.Name
-					reason = fmt.Sprintf("Load Optimization (%d%% > %d%% + 20%%)", currentLoad, best.Load)
+			} else if best != nil && currentName != "" && newSample {
+				// Compare smoothed loads and require the gap to persist, so a single noisy sample doesn't trigger a switch
+				currentEMA := pm.smoothedLoad(currentName, currentLoad)
+				bestEMA := pm.smoothedLoad(best.Name, best.Load)
+				threshold := math.Max(minSwitchDelta, relSwitchDelta*currentEMA)
+
+				if currentEMA > bestEMA+threshold {
+					pm.switchStreak++
+					if pm.switchStreak >= switchConfirmChecks {
+						shouldSwitch = true
+						target = best.Name
+						reason = fmt.Sprintf("Load Optimization (avg %.0f%% > %.0f%% + %.0f%%)", currentEMA, bestEMA, threshold)
+					} else {
+						log(fmt.Sprintf("Load gap (avg %.0f%% > %.0f%% + %.0f%%) seen %d/%d times, waiting to confirm.", currentEMA, bestEMA, threshold, pm.switchStreak, switchConfirmChecks))
+					}
+				} else {
+					pm.switchStreak = 0
 				}
 			}
 
 			if shouldSwitch && target != "" && target != currentName {
 				log(fmt.Sprintf("Initiating switch to %s. Reason: %s", target, reason))
-				if updateEnv(best) {
-					restartGluetun()
-					// Wait for restart
-					time.Sleep(45 * time.Second)
+				result := updateEnv(best)
+				if result == envUnchanged && !healthy {
+					// The restart is the recovery for an unhealthy connection, even to the same endpoint
+					result = envChanged
+				}
+
+				switch result {
+				case envUnchanged:
+					// Gluetun was just reconciled with this endpoint, so a restart would only cause downtime
+					log(fmt.Sprintf("ENV already points at %s's endpoint, skipping restart.", target))
+					pm.switchStreak = 0
+				case envChanged:
+					pm.switchStreak = 0
+					settle := restartGluetun(ctx, best)
+					// Wait for the new connection
+					if !sleepCtx(ctx, settle) {
+						return
+					}
 					// Reset timers
 					lastHealth = time.Now()
 					lastLoad = time.Now()
+					consecutiveHealthy = 0
 				}
 			}
 		}
 
-		time.Sleep(5 * time.Second)
+		// Sleep until the next check is due instead of polling
+		now = time.Now()
+		sleepFor := min(lastHealth.Add(healthCheckEvery(consecutiveHealthy)).Sub(now), lastLoad.Add(loadEvery).Sub(now))
+		if !sleepCtx(ctx, max(time.Second, sleepFor)) {
+			return
+		}
+	}
+}
+
+// Sleep for d, returning false if ctx is cancelled first
+func sleepCtx(ctx context.Context, d time.Duration) bool {
+	t := time.NewTimer(d)
+	defer t.Stop()
+
+	select {
+	case <-ctx.Done():
+		return false
+	case <-t.C:
+		return true
+	}
+}
+
+// Health check interval, stretched (up to maxHealthBackoff times) once the connection has been stable for a while
+func healthCheckEvery(consecutiveHealthy int) time.Duration {
+	mult := 1
+	if consecutiveHealthy > healthBackoffAfter {
+		mult = min(maxHealthBackoff, 1+consecutiveHealthy/healthBackoffAfter)
 	}
+	return time.Duration(healthCheckInterval*mult) * time.Second
 }
 
 
 // --- Helpers ---
 
-func findBestServer(servers []LogicalServer, currentName string) (*LogicalServer, int) {
-	var candidates []LogicalServer
-	currentLoad := 100
+// Server Index (built once per fetch so candidate selection is map lookups, not scans)
+type cityKey struct {
+	Country string // EntryCountry, or "" for any country
+	City    string // lowercased
+}
 
-	for _, s := range servers {
-		if s.Name == currentName {
-			currentLoad = s.Load
-		}
+type serverIndex struct {
+	byCity map[cityKey][]*LogicalServer // active servers only
+	byName map[string]*LogicalServer    // all servers
+}
+
+func indexServers(servers []LogicalServer) serverIndex {
+	idx := serverIndex{
+		byCity: make(map[cityKey][]*LogicalServer),
+		byName: make(map[string]*LogicalServer, len(servers)),
+	}
+
+	for i := range servers {
+		s := &servers[i]
+		idx.byName[s.Name] = s
 
 		if s.Status != 1 {
 			continue
 		}
 
-		if targetCountry != "" && s.EntryCountry != targetCountry {
-			continue
+		city := strings.ToLower(s.City)
+		idx.byCity[cityKey{s.EntryCountry, city}] = append(idx.byCity[cityKey{s.EntryCountry, city}], s)
+		idx.byCity[cityKey{"", city}] = append(idx.byCity[cityKey{"", city}], s)
+	}
+	return idx
+}
+
+func (pm *ProtonManager) findBestServer(idx serverIndex, currentName string) (*LogicalServer, int) {
+	currentLoad := 100
+	if s, ok := idx.byName[currentName]; ok {
+		currentLoad = s.Load
+	}
+
+	// Lowest smoothed load wins, so a momentary dip doesn't pick the target;
+	// a single pass, no candidate slice or sort needed.
+	// Cities are walked in TARGET_CITIES order, so a tie always goes to the same (earlier) server.
+	var best *LogicalServer
+	bestLoad := 0.0
+	for _, city := range targetCityKeys {
+		for _, s := range idx.byCity[cityKey{targetCountry, city}] {
+			if load := pm.smoothedLoad(s.Name, s.Load); best == nil || load < bestLoad {
+				best, bestLoad = s, load
+			}
 		}
+	}
+
+	return best, currentLoad
+}
+
+// Control server probe state: denied latches after a 401/403 (a key mismatch won't fix itself),
+// fallingBack is only used to log the switch to and from the ping once.
+// doubt is set after an unhealthy result and cleared by the next successful ping.
+var controlProbe struct {
+	denied      bool
+	fallingBack bool
+	doubt       bool
+	lastPing    time.Time
+}
 
-		// Check city match
-		cityMatch := false
-		for _, city := range targetCities {
-			if strings.EqualFold(s.City, strings.TrimSpace(city)) {
-				cityMatch = true
-				break
+// Reports false only when the tunnel is known to be down; inconclusive probes never trigger a failover
+func checkConnectivity(ctx context.Context) bool {
+	if !useDockerExecHealthcheck && !controlProbe.denied {
+		healthy, err := checkConnectivityControlServer(ctx)
+		if err == nil {
+			if controlProbe.fallingBack {
+				log("Control server health check available again.")
+				controlProbe.fallingBack = false
+			}
+			if !healthy {
+				controlProbe.doubt = true
+				return false
 			}
+			return confirmConnectivity(ctx)
 		}
-		
-		if cityMatch {
-			candidates = append(candidates, s)
+
+		var statusErr controlStatusError
+		switch {
+		case errors.As(err, &statusErr) && (statusErr == http.StatusUnauthorized || statusErr == http.StatusForbidden):
+			log(fmt.Sprintf("Control server rejected the health check (%v); check GLUETUN_CONTROL_API_KEY. Using docker exec ping from now on.", err))
+			controlProbe.denied = true
+		case !controlProbe.fallingBack:
+			log(fmt.Sprintf("Control server health check inconclusive: %v. Falling back to docker exec ping.", err))
+			controlProbe.fallingBack = true
+		default:
+			logDebug(fmt.Sprintf("Control server health check inconclusive: %v", err))
 		}
 	}
 
-	if len(candidates) == 0 {
-		return nil, currentLoad
+	healthy, err := checkConnectivityDockerExec(ctx)
+	if err != nil {
+		log(fmt.Sprintf("Health check unavailable: %v. Not treating as unhealthy.", err))
+		return true
 	}
+	controlProbe.lastPing = time.Now()
+	controlProbe.doubt = !healthy
+	return healthy
+}
 
-	// Sort by Load ASC
-	sort.Slice(candidates, func(i, j int) bool {
-		return candidates[i].Load < candidates[j].Load
-	})
+// The control server only proves the tunnel came up, so ping through it end to end
+// at least every 5x HEALTH_CHECK_INTERVAL, and on every check while in doubt
+func confirmConnectivity(ctx context.Context) bool {
+	if !controlProbe.doubt && time.Since(controlProbe.lastPing) < time.Duration(5*healthCheckInterval)*time.Second {
+		return true
+	}
 
-	return &candidates[0], currentLoad
+	healthy, err := checkConnectivityDockerExec(ctx)
+	if err != nil {
+		logDebug(fmt.Sprintf("End-to-end ping unavailable: %v", err))
+		return true
+	}
+	controlProbe.lastPing = time.Now()
+	controlProbe.doubt = !healthy
+	if !healthy {
+		log("Gluetun reports the VPN as running, but the ping through the tunnel failed.")
+	}
+	return healthy
 }
 
-func checkConnectivity() bool {
+// Ask Gluetun's control server directly instead of spawning a docker exec.
+// The VPN loop must be running and Gluetun must have fetched a public IP. That lookup goes through the tunnel,
+// but it happens once per connection and is cached, so it shows the tunnel came up, not that it still passes traffic.
+// Errors (unreachable, auth rejected, no public IP yet) mean the result is unknown.
+func checkConnectivityControlServer(ctx context.Context) (bool, error) {
+	var status struct {
+		Status string `json:"status"`
+	}
+	if err := gluetunControlRequest(ctx, "GET", "/v1/vpn/status", nil, &status); err != nil {
+		return false, err
+	}
+	if status.Status != "running" {
+		log(fmt.Sprintf("Gluetun VPN status: %q", status.Status))
+		return false, nil
+	}
+
+	var ip struct {
+		PublicIP string `json:"public_ip"`
+	}
+	if err := gluetunControlRequest(ctx, "GET", "/v1/publicip/ip", nil, &ip); err != nil {
+		return false, err
+	}
+	if ip.PublicIP == "" {
+		return false, fmt.Errorf("no public IP reported")
+	}
+	return true, nil
+}
+
+// Ping through the tunnel from inside the Gluetun container.
+// A failed ping means unhealthy; not being able to reach docker or run ping at all is an error.
+func checkConnectivityDockerExec(ctx context.Context) (bool, error) {
 	// Use gluetunContainer (name) for docker exec
-	cmd := exec.Command("docker", "exec", "-i", gluetunContainer, "ping", "-c", "3", "-W", "2", pingTarget)
-	if err := cmd.Run(); err != nil {
-		return false
+	cmd := exec.CommandContext(ctx, "docker", "exec", gluetunContainer, "ping", "-c", "3", "-W", "2", pingTarget)
+	output, err := cmd.CombinedOutput()
+	var exitErr *exec.ExitError
+	if errors.As(err, &exitErr) {
+		if dockerFailed(exitErr.ExitCode(), string(output)) {
+			return false, fmt.Errorf("docker exec failed: %s", strings.TrimSpace(string(output)))
+		}
+		return false, nil
 	}
-	return true
+	if err != nil {
+		return false, err
+	}
+	return true, nil
+}
+
+// Tell the docker CLI's own failures apart from ping's exit status
+func dockerFailed(code int, output string) bool {
+	// 126/127: ping could not be executed in the container
+	if code == 126 || code == 127 {
+		return true
+	}
+	for _, msg := range []string{
+		"Cannot connect to the Docker daemon",
+		"permission denied while trying to connect",
+		"No such container",
+	} {
+		if strings.Contains(output, msg) {
+			return true
+		}
+	}
+	return false
+}
+
+// Non-2xx status from the Gluetun control server
+type controlStatusError int
+
+func (e controlStatusError) Error() string {
+	return fmt.Sprintf("control server returned status %d", int(e))
+}
+
+// Send a request to Gluetun's HTTP control server, decoding the JSON response into out (if non-nil)
+func gluetunControlRequest(ctx context.Context, method, path string, body, out interface{}) error {
+	var reqBody io.Reader
+	if body != nil {
+		payload, err := json.Marshal(body)
+		if err != nil {
+			return err
+		}
+		reqBody = bytes.NewReader(payload)
+	}
+
+	req, err := http.NewRequestWithContext(ctx, method, gluetunControlURL+path, reqBody)
+	if err != nil {
+		return err
+	}
+	if body != nil {
+		req.Header.Set("Content-Type", "application/json")
+	}
+	if gluetunControlAPIKey != "" {
+		req.Header.Set("X-API-Key", gluetunControlAPIKey)
+	}
+
+	resp, err := controlClient.Do(req)
+	if err != nil {
+		return err
+	}
+	defer resp.Body.Close()
+
+	if resp.StatusCode < 200 || resp.StatusCode > 299 {
+		return controlStatusError(resp.StatusCode)
+	}
+
+	if out == nil {
+		return nil
+	}
+	return json.NewDecoder(resp.Body).Decode(out)
+}
+
+// Last parsed PROTON_SERVER_NAME, keyed on the env file's mtime and size
+var envCache struct {
+	valid   bool
+	modTime time.Time
+	size    int64
+	name    string
 }
 
 func getCurrentServerFromEnv() string {
-	data, err := os.ReadFile(envFile)
+	info, err := os.Stat(envFile)
+	if err != nil {
+		envCache.valid = false
+		return ""
+	}
+	if envCache.valid && info.ModTime().Equal(envCache.modTime) && info.Size() == envCache.size {
+		return envCache.name
+	}
+
+	f, err := os.Open(envFile)
 	if err != nil {
 		return ""
 	}
-	lines := strings.Split(string(data), "\n")
-	for _, line := range lines {
-		if strings.HasPrefix(line, "PROTON_SERVER_NAME=") {
-			return strings.TrimPrefix(line, "PROTON_SERVER_NAME=")
+	defer f.Close()
+
+	// Stream line by line and stop at the first match (ReadString has no line-length limit)
+	const prefix = "PROTON_SERVER_NAME="
+	name := ""
+	r := bufio.NewReader(f)
+	for {
+		line, err := r.ReadString('\n')
+		if strings.HasPrefix(line, prefix) {
+			name = strings.TrimSuffix(strings.TrimSuffix(line[len(prefix):], "\n"), "\r")
+			break
+		}
+		if err == io.EOF {
+			break
+		}
+		if err != nil {
+			log(fmt.Sprintf("Error reading env file: %v", err))
+			return ""
 		}
 	}
-	return ""
+
+	envCache.valid = true
+	envCache.modTime = info.ModTime()
+	envCache.size = info.Size()
+	envCache.name = name
+	return name
 }
 
-func updateEnv(server *LogicalServer) bool {
-	// Find WireGuard Key
-	var wgServer *Server
-	for _, s := range server.Servers {
-		if s.X25519PublicKey != "" {
-			wgServer = &s
+// WireGuard endpoint vars from the env file; ok is false if they aren't all set
+func getEndpointFromEnv() (endpoint wireguardEndpoint, ok bool) {
+	f, err := os.Open(envFile)
+	if err != nil {
+		return endpoint, false
+	}
+	defer f.Close()
+
+	port := ""
+	r := bufio.NewReader(f)
+	for {
+		line, err := r.ReadString('\n')
+		if k, v, found := strings.Cut(line, "="); found && !strings.HasPrefix(strings.TrimSpace(line), "#") {
+			v = strings.TrimSpace(v)
+			switch strings.TrimSpace(k) {
+			case "WIREGUARD_ENDPOINT_IP":
+				endpoint.IP = v
+			case "WIREGUARD_ENDPOINT_PORT":
+				port = v
+			case "WIREGUARD_PUBLIC_KEY":
+				endpoint.PublicKey = v
+			}
+		}
+		if err != nil {
 			break
 		}
 	}
 
+	endpoint.Port, err = strconv.Atoi(port)
+	return endpoint, err == nil && endpoint.IP != "" && endpoint.PublicKey != ""
+}
+
+// Find the first physical server with a WireGuard key
+func findWireguardServer(server *LogicalServer) *Server {
+	for i := range server.Servers {
+		if server.Servers[i].X25519PublicKey != "" {
+			return &server.Servers[i]
+		}
+	}
+	return nil
+}
+
+// Outcome of updateEnv
+type envUpdateResult int
+
+const (
+	envUpdateFailed envUpdateResult = iota
+	envUnchanged                    // endpoint vars already held these values (the name may have been rewritten)
+	envChanged
+)
+
+func updateEnv(server *LogicalServer) envUpdateResult {
+	// Find WireGuard Key
+	wgServer := findWireguardServer(server)
 	if wgServer == nil {
 		log(fmt.Sprintf("Error: No WireGuard key found for server %s", server.Name))
-		return false
+		return envUpdateFailed
 	}
 
 	log(fmt.Sprintf("Updating ENV: Name=%s, IP=%s", server.Name, wgServer.EntryIP))
 
-	// Read existing
+	// Read existing. Lines keep their "\r" (CRLF files) and trailing blank lines are kept as they are.
 	content, _ := os.ReadFile(envFile)
-	lines := strings.Split(string(content), "\n")
-	
-	newLines := []string{}
+	text := string(content)
+	cr := ""
+	if strings.Contains(text, "\r\n") {
+		cr = "\r"
+	}
+	var lines []string
+	if text != "" {
+		lines = strings.Split(strings.TrimSuffix(text, "\n"), "\n")
+		if !strings.HasSuffix(text, "\n") && !strings.HasSuffix(lines[len(lines)-1], cr) {
+			// Unterminated last line: it gets the file's line ending on write
+			lines[len(lines)-1] += cr
+		}
+	}
+
+	// Ordered so appended vars are written deterministically
+	managedKeys := []string{"PROTON_SERVER_NAME", "WIREGUARD_ENDPOINT_IP", "WIREGUARD_ENDPOINT_PORT", "WIREGUARD_PUBLIC_KEY"}
 	managedVars := map[string]string{
 		"PROTON_SERVER_NAME":      server.Name,
 		"WIREGUARD_ENDPOINT_IP":   wgServer.EntryIP,
 		"WIREGUARD_ENDPOINT_PORT": "51820",
 		"WIREGUARD_PUBLIC_KEY":    wgServer.X25519PublicKey,
 	}
-	foundVars := make(map[string]bool)
+	foundVars := make(map[string]bool, len(managedVars))
+	rewrite := false // any managed line needs (re)writing, including the name
+	changed := false // the WireGuard endpoint (IP, port, key) actually differs
 
-	for _, line := range lines {
-		updated := false
-		for k, v := range managedVars {
-			if strings.HasPrefix(line, k+"=") {
-				newLines = append(newLines, fmt.Sprintf("%s=%s", k, v))
-				foundVars[k] = true
-				updated = true
-				break
-			}
+	// Single pass: one map lookup per line, comments and ordering preserved
+	for i, line := range lines {
+		if strings.HasPrefix(strings.TrimSpace(line), "#") {
+			continue
+		}
+		line, lineCR := strings.CutSuffix(line, "\r")
+		k, v, ok := strings.Cut(line, "=")
+		if !ok {
+			continue
 		}
-		if !updated {
-			newLines = append(newLines, line)
+		k = strings.TrimSpace(k)
+		want, managed := managedVars[k]
+		if !managed {
+			continue
+		}
+		foundVars[k] = true
+		if line != k+"="+want {
+			lines[i] = k + "=" + want
+			if lineCR {
+				lines[i] += "\r"
+			}
+			rewrite = true
+			if k != "PROTON_SERVER_NAME" && strings.TrimSpace(v) != want {
+				changed = true
+			}
 		}
 	}
 
-	// Append missing
-	for k, v := range managedVars {
+	// Append missing after the last non-blank line, so trailing blank lines stay at the end
+	var missing []string
+	for _, k := range managedKeys {
 		if !foundVars[k] {
-			newLines = append(newLines, fmt.Sprintf("%s=%s", k, v))
+			missing = append(missing, k+"="+managedVars[k]+cr)
+			rewrite = true
+			if k != "PROTON_SERVER_NAME" {
+				changed = true
+			}
 		}
 	}
+	if len(missing) > 0 {
+		at := len(lines)
+		for at > 0 && strings.TrimSpace(lines[at-1]) == "" {
+			at--
+		}
+		lines = slices.Insert(lines, at, missing...)
+	}
 
-	// Write back
-	output := strings.Join(newLines, "\n")
-	// Ensure newline at end
-	if !strings.HasSuffix(output, "\n") {
-		output += "\n"
+	result := envUnchanged
+	if changed {
+		result = envChanged
 	}
-	
-	if err := os.WriteFile(envFile, []byte(output), 0644); err != nil {
+	if !rewrite {
+		log("ENV already up to date, skipping write.")
+		return result
+	}
+
+	// Write back, ensuring newline at end
+	output := strings.Join(lines, "\n") + "\n"
+	// Holds credentials and WireGuard keys: owner-only
+	if err := writeFileAtomic(envFile, []byte(output), 0600); err != nil {
 		log(fmt.Sprintf("Error updating env: %v", err))
+		return envUpdateFailed
+	}
+	return result
+}
+
+// Write to a temp file in the same directory and rename it over path.
+// An existing file keeps its owner and its mode, narrowed to perm.
+// Falls back to an in-place write if the rename fails (e.g. path is itself a bind mount).
+func writeFileAtomic(path string, data []byte, perm os.FileMode) error {
+	uid, gid := -1, -1
+	if info, err := os.Stat(path); err == nil {
+		perm &= info.Mode().Perm()
+		if st, ok := info.Sys().(*syscall.Stat_t); ok {
+			uid, gid = int(st.Uid), int(st.Gid)
+		}
+	}
+
+	tmp, err := os.CreateTemp(filepath.Dir(path), "."+filepath.Base(path)+".tmp*")
+	if err != nil {
+		return writeFileInPlace(path, data, perm)
+	}
+	tmpName := tmp.Name()
+
+	_, err = tmp.Write(data)
+	if closeErr := tmp.Close(); err == nil {
+		err = closeErr
+	}
+	if err == nil {
+		err = os.Chmod(tmpName, perm)
+	}
+	if err == nil && uid != -1 {
+		// Best effort: keep the host user's ownership of files on shared volumes
+		os.Chown(tmpName, uid, gid)
+	}
+	if err == nil {
+		err = os.Rename(tmpName, path)
+	}
+	if err != nil {
+		os.Remove(tmpName)
+		return writeFileInPlace(path, data, perm)
+	}
+	return nil
+}
+
+func writeFileInPlace(path string, data []byte, perm os.FileMode) error {
+	if err := os.WriteFile(path, data, perm); err != nil {
+		return err
+	}
+	os.Chmod(path, perm)
+	return nil
+}
+
+// Point Gluetun at server, returning how long to wait for the new connection to settle
+func restartGluetun(ctx context.Context, server *LogicalServer) time.Duration {
+	if useControlServerSwitch {
+		if err := switchViaControlServer(ctx, server); err == nil {
+			log("Switched server via Gluetun control server.")
+			return 5 * time.Second
+		} else {
+			log(fmt.Sprintf("Control server switch failed: %v. Falling back to recreate.", err))
+		}
+	}
+
+	recreateGluetun(ctx)
+	return 45 * time.Second
+}
+
+// Hot-swap the WireGuard endpoint without recreating the container.
+// This only changes Gluetun's in-memory settings: the .env file is updated beforehand so a compose
+// recreate picks up the same server, but a plain container restart goes back to the endpoint the
+// container was created with until reconcileGluetunEndpoint re-applies the .env one.
+func switchViaControlServer(ctx context.Context, server *LogicalServer) error {
+	wgServer := findWireguardServer(server)
+	if wgServer == nil {
+		return fmt.Errorf("no WireGuard key found for server %s", server.Name)
+	}
+	return putGluetunEndpoint(ctx, wireguardEndpoint{IP: wgServer.EntryIP, Port: 51820, PublicKey: wgServer.X25519PublicKey})
+}
+
+// WireGuard endpoint as found in Gluetun's settings (provider.server_selection.wireguard)
+type wireguardEndpoint struct {
+	IP        string `json:"endpoint_ip"`
+	Port      int    `json:"endpoint_port"`
+	PublicKey string `json:"public_key"`
+}
+
+func putGluetunEndpoint(ctx context.Context, endpoint wireguardEndpoint) error {
+	settings := map[string]interface{}{
+		"provider": map[string]interface{}{
+			"server_selection": map[string]interface{}{
+				"wireguard": endpoint,
+			},
+		},
+	}
+	return gluetunControlRequest(ctx, "PUT", "/v1/vpn/settings", settings, nil)
+}
+
+// Make Gluetun's live endpoint match the one in .env, re-sending it after Gluetun was restarted
+// with the endpoint it was created with. Returns false if Gluetun couldn't be asked, so the caller retries.
+func reconcileGluetunEndpoint(ctx context.Context) bool {
+	want, ok := getEndpointFromEnv()
+	if !ok {
+		return true
+	}
+
+	var settings struct {
+		Provider struct {
+			ServerSelection struct {
+				Wireguard wireguardEndpoint `json:"wireguard"`
+			} `json:"server_selection"`
+		} `json:"provider"`
+	}
+	if err := gluetunControlRequest(ctx, "GET", "/v1/vpn/settings", nil, &settings); err != nil {
+		logDebug(fmt.Sprintf("Could not read Gluetun settings: %v", err))
+		return false
+	}
+
+	live := settings.Provider.ServerSelection.Wireguard
+	if live == want {
+		return true
+	}
+	log(fmt.Sprintf("Gluetun is using endpoint %s:%d, but .env has %s:%d. Re-applying the .env endpoint.", live.IP, live.Port, want.IP, want.Port))
+	if err := putGluetunEndpoint(ctx, want); err != nil {
+		log(fmt.Sprintf("Failed to re-apply the .env endpoint: %v", err))
 		return false
 	}
 	return true
 }
 
-func restartGluetun() {
+func recreateGluetun(ctx context.Context) {
 	log("Recreating Gluetun...")
-	
+
+	recreateCtx, cancel := context.WithTimeout(ctx, 120*time.Second)
+	defer cancel()
+
 	// Use gluetunService for docker-compose up
 	cmdArgs := []string{"up", "-d", "--force-recreate", gluetunService}
-	cmd := exec.Command("docker-compose", cmdArgs...)
-	
 	if _, err := os.Stat("/project/docker-compose.yml"); err == nil {
-		cmd = exec.Command("docker-compose", "-f", "/project/docker-compose.yml", "up", "-d", "--force-recreate", gluetunService)
+		cmdArgs = append([]string{"-f", "/project/docker-compose.yml"}, cmdArgs...)
 	}
+	cmd := exec.CommandContext(recreateCtx, "docker-compose", cmdArgs...)
 
 	if output, err := cmd.CombinedOutput(); err != nil {
+		if ctx.Err() != nil {
+			return
+		}
 		log(fmt.Sprintf("Failed to recreate gluetun: %v\nOutput: %s", err, string(output)))
 		// Fallback - Use gluetunContainer for direct docker restart
-		exec.Command("docker", "restart", gluetunContainer).Run()
+		restartCtx, restartCancel := context.WithTimeout(ctx, 120*time.Second)
+		defer restartCancel()
+		exec.CommandContext(restartCtx, "docker", "restart", gluetunContainer).Run()
 	}
 }
 
+// Logging: one write per line, serialized (the health probe logs from its own goroutine),
+// with the formatted timestamp reused for all lines within the same second
+var logState struct {
+	sync.Mutex
+	sec   int64
+	stamp string
+}
+
 func log(msg string) {
-	fmt.Printf("[%s] %s\n", time.Now().Format("2006-01-02 15:04:05"), msg)
+	now := time.Now()
+
+	logState.Lock()
+	defer logState.Unlock()
+
+	if sec := now.Unix(); sec != logState.sec || logState.stamp == "" {
+		logState.sec = sec
+		logState.stamp = now.Format("2006-01-02 15:04:05")
+	}
+	os.Stdout.WriteString("[" + logState.stamp + "] " + msg + "\n")
+}
+
+// Per-tick detail, only shown with LOG_LEVEL=debug
+func logDebug(msg string) {
+	if debugLogging {
+		log(msg)
+	}
 }
 
 func getEnv(key, fallback string) string {
@@ -652,6 +1500,16 @@ func getEnvInt(key string, fallback int) int {
 	return fallback
 }
 
+func getEnvBool(key string, fallback bool) bool {
+	switch strings.ToLower(os.Getenv(key)) {
+	case "1", "true", "yes", "on":
+		return true
+	case "0", "false", "no", "off":
+		return false
+	}
+	return fallback
+}
+
 func getDir(path string) string {
 	// naive dirname
 	lastSlash := strings.LastIndex(path, "/")
@@ -0,0 +1,345 @@
+package main
+
+import (
+	"context"
+	"net/http"
+	"net/http/httptest"
+	"net/url"
+	"os"
+	"path/filepath"
+	"sync"
+	"syscall"
+	"testing"
+)
+
+var testServer = &LogicalServer{
+	Name:    "US-CA#1",
+	Servers: []Server{{EntryIP: "1.2.3.4", X25519PublicKey: "KEY"}},
+}
+
+const testManaged = "PROTON_SERVER_NAME=US-CA#1\nWIREGUARD_ENDPOINT_IP=1.2.3.4\nWIREGUARD_ENDPOINT_PORT=51820\nWIREGUARD_PUBLIC_KEY=KEY\n"
+
+func TestUpdateEnv(t *testing.T) {
+	tests := []struct {
+		name string
+		in   string
+		want string
+		res  envUpdateResult
+	}{
+		{
+			name: "empty file",
+			in:   "",
+			want: testManaged,
+			res:  envChanged,
+		},
+		{
+			name: "comments and order preserved",
+			in:   "# header\nFOO=bar\nWIREGUARD_ENDPOINT_IP=9.9.9.9\n# keep me\nPROTON_SERVER_NAME=OLD\nWIREGUARD_ENDPOINT_PORT=51820\nWIREGUARD_PUBLIC_KEY=OLDKEY\n",
+			want: "# header\nFOO=bar\nWIREGUARD_ENDPOINT_IP=1.2.3.4\n# keep me\nPROTON_SERVER_NAME=US-CA#1\nWIREGUARD_ENDPOINT_PORT=51820\nWIREGUARD_PUBLIC_KEY=KEY\n",
+			res:  envChanged,
+		},
+		{
+			name: "commented out keys are not managed",
+			in:   "#WIREGUARD_ENDPOINT_IP=9.9.9.9\nFOO=bar\n",
+			want: "#WIREGUARD_ENDPOINT_IP=9.9.9.9\nFOO=bar\n" + testManaged,
+			res:  envChanged,
+		},
+		{
+			name: "indented key with same value is rewritten but unchanged",
+			in:   "PROTON_SERVER_NAME=US-CA#1\n  WIREGUARD_ENDPOINT_IP = 1.2.3.4\nWIREGUARD_ENDPOINT_PORT=51820\nWIREGUARD_PUBLIC_KEY=KEY\n",
+			want: testManaged,
+			res:  envUnchanged,
+		},
+		{
+			name: "name only change is rewritten but unchanged",
+			in:   "PROTON_SERVER_NAME=OLD\nWIREGUARD_ENDPOINT_IP=1.2.3.4\nWIREGUARD_ENDPOINT_PORT=51820\nWIREGUARD_PUBLIC_KEY=KEY\n",
+			want: testManaged,
+			res:  envUnchanged,
+		},
+		{
+			name: "up to date",
+			in:   "FOO=bar\n" + testManaged,
+			want: "FOO=bar\n" + testManaged,
+			res:  envUnchanged,
+		},
+		{
+			name: "missing vars appended",
+			in:   "FOO=bar\nWIREGUARD_ENDPOINT_IP=1.2.3.4\n",
+			want: "FOO=bar\nWIREGUARD_ENDPOINT_IP=1.2.3.4\nPROTON_SERVER_NAME=US-CA#1\nWIREGUARD_ENDPOINT_PORT=51820\nWIREGUARD_PUBLIC_KEY=KEY\n",
+			res:  envChanged,
+		},
+		{
+			name: "crlf line endings kept",
+			in:   "FOO=bar\r\nWIREGUARD_ENDPOINT_IP=9.9.9.9\r\n",
+			want: "FOO=bar\r\nWIREGUARD_ENDPOINT_IP=1.2.3.4\r\nPROTON_SERVER_NAME=US-CA#1\r\nWIREGUARD_ENDPOINT_PORT=51820\r\nWIREGUARD_PUBLIC_KEY=KEY\r\n",
+			res:  envChanged,
+		},
+		{
+			name: "crlf without final newline",
+			in:   "FOO=bar\r\nBAZ=qux",
+			want: "FOO=bar\r\nBAZ=qux\r\nPROTON_SERVER_NAME=US-CA#1\r\nWIREGUARD_ENDPOINT_IP=1.2.3.4\r\nWIREGUARD_ENDPOINT_PORT=51820\r\nWIREGUARD_PUBLIC_KEY=KEY\r\n",
+			res:  envChanged,
+		},
+		{
+			name: "trailing blank lines kept",
+			in:   "FOO=bar\n\n\n",
+			want: "FOO=bar\n" + testManaged + "\n\n",
+			res:  envChanged,
+		},
+		{
+			name: "no final newline",
+			in:   "FOO=bar",
+			want: "FOO=bar\n" + testManaged,
+			res:  envChanged,
+		},
+	}
+
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			envFile = filepath.Join(t.TempDir(), ".env")
+			if err := os.WriteFile(envFile, []byte(tt.in), 0600); err != nil {
+				t.Fatal(err)
+			}
+
+			if res := updateEnv(testServer); res != tt.res {
+				t.Errorf("updateEnv() = %v, want %v", res, tt.res)
+			}
+			got, err := os.ReadFile(envFile)
+			if err != nil {
+				t.Fatal(err)
+			}
+			if string(got) != tt.want {
+				t.Errorf("env file:\n got %q\nwant %q", got, tt.want)
+			}
+		})
+	}
+}
+
+func TestUpdateEnvNoWireguardKey(t *testing.T) {
+	envFile = filepath.Join(t.TempDir(), ".env")
+	os.WriteFile(envFile, []byte("FOO=bar\n"), 0600)
+
+	if res := updateEnv(&LogicalServer{Name: "US-CA#2"}); res != envUpdateFailed {
+		t.Errorf("updateEnv() = %v, want envUpdateFailed", res)
+	}
+	if got, _ := os.ReadFile(envFile); string(got) != "FOO=bar\n" {
+		t.Errorf("env file changed: %q", got)
+	}
+}
+
+func TestWriteFileAtomicMode(t *testing.T) {
+	tests := []struct {
+		name     string
+		existing os.FileMode // 0 means no existing file
+		perm     os.FileMode
+		want     os.FileMode
+	}{
+		{"new file", 0, 0600, 0600},
+		{"narrowed to perm", 0644, 0600, 0600},
+		{"narrower existing mode kept", 0400, 0600, 0400},
+		{"group bits dropped", 0640, 0600, 0600},
+	}
+
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			dir := t.TempDir()
+			path := filepath.Join(dir, "file")
+			if tt.existing != 0 {
+				if err := os.WriteFile(path, []byte("old"), tt.existing); err != nil {
+					t.Fatal(err)
+				}
+				os.Chmod(path, tt.existing)
+			}
+
+			if err := writeFileAtomic(path, []byte("new"), tt.perm); err != nil {
+				t.Fatal(err)
+			}
+
+			info, err := os.Stat(path)
+			if err != nil {
+				t.Fatal(err)
+			}
+			if got := info.Mode().Perm(); got != tt.want {
+				t.Errorf("mode = %o, want %o", got, tt.want)
+			}
+			if data, _ := os.ReadFile(path); string(data) != "new" {
+				t.Errorf("content = %q, want %q", data, "new")
+			}
+			if entries, _ := os.ReadDir(dir); len(entries) != 1 {
+				t.Errorf("temp file left behind: %v", entries)
+			}
+		})
+	}
+}
+
+func TestWriteFileAtomicOwner(t *testing.T) {
+	if os.Geteuid() != 0 {
+		t.Skip("chown needs root")
+	}
+
+	path := filepath.Join(t.TempDir(), "file")
+	os.WriteFile(path, []byte("old"), 0600)
+	if err := os.Chown(path, 1234, 5678); err != nil {
+		t.Fatal(err)
+	}
+
+	if err := writeFileAtomic(path, []byte("new"), 0600); err != nil {
+		t.Fatal(err)
+	}
+
+	info, err := os.Stat(path)
+	if err != nil {
+		t.Fatal(err)
+	}
+	st := info.Sys().(*syscall.Stat_t)
+	if st.Uid != 1234 || st.Gid != 5678 {
+		t.Errorf("owner = %d:%d, want 1234:5678", st.Uid, st.Gid)
+	}
+}
+
+const testLogicals = `{"Code":1000,"LogicalServers":[{"Name":"US-CA#1","City":"San Jose","Load":10}]}`
+
+// Sends every request to the test server instead of the Proton API
+type redirectTransport struct {
+	target *url.URL
+}
+
+func (rt redirectTransport) RoundTrip(req *http.Request) (*http.Response, error) {
+	req = req.Clone(req.Context())
+	req.URL.Scheme = rt.target.Scheme
+	req.URL.Host = rt.target.Host
+	return http.DefaultTransport.RoundTrip(req)
+}
+
+// Fake /vpn/logicals serving testLogicals with ETag "v1", recording each request's If-None-Match
+type fakeLogicals struct {
+	mu          sync.Mutex
+	ifNoneMatch []string
+}
+
+func (f *fakeLogicals) ServeHTTP(w http.ResponseWriter, r *http.Request) {
+	f.mu.Lock()
+	f.ifNoneMatch = append(f.ifNoneMatch, r.Header.Get("If-None-Match"))
+	f.mu.Unlock()
+
+	if r.Header.Get("If-None-Match") == `"v1"` {
+		w.WriteHeader(http.StatusNotModified)
+		return
+	}
+	w.Header().Set("ETag", `"v1"`)
+	w.Write([]byte(testLogicals))
+}
+
+func (f *fakeLogicals) requests() []string {
+	f.mu.Lock()
+	defer f.mu.Unlock()
+	return append([]string(nil), f.ifNoneMatch...)
+}
+
+// Point the API client and cache at a fake server and a temp dir for the duration of the test
+func newTestAPI(t *testing.T, ttl int) (*ProtonManager, *fakeLogicals) {
+	t.Helper()
+	api := &fakeLogicals{}
+	srv := httptest.NewServer(api)
+	t.Cleanup(srv.Close)
+	target, _ := url.Parse(srv.URL)
+
+	oldTransport, oldCacheDir, oldTTL := apiClient.Transport, cacheDir, logicalsTTL
+	t.Cleanup(func() {
+		apiClient.Transport, cacheDir, logicalsTTL = oldTransport, oldCacheDir, oldTTL
+	})
+	apiClient.Transport = redirectTransport{target}
+	cacheDir = t.TempDir()
+	logicalsTTL = ttl
+
+	return &ProtonManager{loadEMA: make(map[string]float64)}, api
+}
+
+func checkLogicals(t *testing.T, servers []LogicalServer, err error) {
+	t.Helper()
+	if err != nil {
+		t.Fatal(err)
+	}
+	if len(servers) != 1 || servers[0].Name != "US-CA#1" {
+		t.Fatalf("servers = %+v", servers)
+	}
+}
+
+func TestGetLogicalsTTLHit(t *testing.T) {
+	pm, api := newTestAPI(t, 300)
+	ctx := context.Background()
+
+	servers, err := pm.getLogicals(ctx, nil)
+	checkLogicals(t, servers, err)
+	if !pm.lastFetchLive {
+		t.Error("first fetch not counted as live")
+	}
+
+	servers, err = pm.getLogicals(ctx, nil)
+	checkLogicals(t, servers, err)
+	if pm.lastFetchLive {
+		t.Error("TTL cache hit counted as live")
+	}
+	if got := api.requests(); len(got) != 1 {
+		t.Errorf("requests = %q, want exactly one", got)
+	}
+}
+
+func TestGetLogicalsNotModified(t *testing.T) {
+	pm, api := newTestAPI(t, 0)
+	ctx := context.Background()
+
+	servers, err := pm.getLogicals(ctx, nil)
+	checkLogicals(t, servers, err)
+
+	servers, err = pm.getLogicals(ctx, nil)
+	checkLogicals(t, servers, err)
+	if !pm.lastFetchLive {
+		t.Error("304 after the TTL not counted as live")
+	}
+	if got := api.requests(); len(got) != 2 || got[0] != "" || got[1] != `"v1"` {
+		t.Errorf("If-None-Match per request = %q, want [\"\" \"v1\"]", got)
+	}
+}
+
+func TestGetLogicalsCorruptCache(t *testing.T) {
+	tests := []struct {
+		name string
+		ttl  int
+		want []string // If-None-Match per request
+	}{
+		// Stale: revalidated with the ETag, the 304 can't be used, so it refetches unconditionally
+		{"stale", 0, []string{`"v1"`, ""}},
+		// Fresh: the unreadable body is never revalidated
+		{"fresh", 300, []string{""}},
+	}
+
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			pm, api := newTestAPI(t, tt.ttl)
+			os.WriteFile(filepath.Join(cacheDir, "logicals.json"), []byte("{not json"), 0644)
+			os.WriteFile(filepath.Join(cacheDir, "logicals.etag"), []byte(`"v1"`), 0644)
+
+			servers, err := pm.getLogicals(context.Background(), nil)
+			checkLogicals(t, servers, err)
+			if !pm.lastFetchLive {
+				t.Error("refetch not counted as live")
+			}
+
+			got := api.requests()
+			if len(got) != len(tt.want) {
+				t.Fatalf("If-None-Match per request = %q, want %q", got, tt.want)
+			}
+			for i := range got {
+				if got[i] != tt.want[i] {
+					t.Fatalf("If-None-Match per request = %q, want %q", got, tt.want)
+				}
+			}
+
+			// The cache was repaired
+			if _, err := decodeLogicalsFile(filepath.Join(cacheDir, "logicals.json")); err != nil {
+				t.Errorf("cache still unreadable: %v", err)
+			}
+		})
+	}
+}